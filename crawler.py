@@ -1,25 +1,52 @@
 """A simple web crawler -- class implementing crawling logic."""
 
 import asyncio
-import cgi
+import codecs
+import html
 import logging
 import re
+import sys
 import time
 import urllib.parse
-from bs4 import BeautifulSoup, SoupStrainer
-from collections import namedtuple, OrderedDict
-
-try:
-    # Python 3.4.
-    from asyncio import JoinableQueue as Queue
-except ImportError:
-    # Python 3.5.
-    from asyncio import Queue
+from collections import deque, namedtuple
+from pybloom_live import ScalableBloomFilter
+from selectolax.lexbor import LexborHTMLParser
 
 import aiohttp  # Install with "pip install aiohttp".
 
 LOGGER = logging.getLogger(__name__)
 
+# href values of <a> tags, matched on the raw response body. The attribute
+# name must not be part of a longer one such as data-href or xlink:href.
+_HREF_RE = re.compile(
+    rb'''<a\s[^>]*?(?<![\w:-])href\s*=\s*["']?([^"'<>\s]+)''',
+    re.IGNORECASE)
+# Scheme and host (without port) of a crawlable URL.
+_URL_RE = re.compile(r'^(https?)://([^/:?#]+)', re.IGNORECASE)
+
+# Sizing of the Bloom filter remembering seen URLs. A false positive only
+# means a page is not crawled.
+SEEN_URLS_CAPACITY = 1000000
+SEEN_URLS_ERROR_RATE = 1e-4
+
+# Per-request limits (seconds) so a slow server cannot hold a worker.
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=10, sock_read=15)
+
+
+def _find_hrefs(body):
+    """Return the raw href values of the <a> tags in an HTML body.
+
+    >>> _find_hrefs(b'<a class="x" HREF="/a">a</a>' b"<a href='/b'>b</a>")
+    [b'/a', b'/b']
+    >>> _find_hrefs(b'<a href = "/spaced"><a href=/bare>')
+    [b'/spaced', b'/bare']
+    >>> _find_hrefs(b'<a data-href="/c"><a ng-href="/d"><a xlink:href="/e">')
+    []
+    >>> _find_hrefs(b'<a data-href="/c" href="/f">')
+    [b'/f']
+    """
+    return _HREF_RE.findall(body)
+
 
 FetchStatistic = namedtuple('FetchStatistic',
                             ['url',
@@ -36,24 +63,41 @@ FetchStatistic = namedtuple('FetchStatistic',
 class Crawler:
     """Crawl a set of URLs.
 
-    This manages two sets of URLs: 'urls' and 'done'.  'urls' is a set of
-    URLs seen, and 'done' is a list of FetchStatistics.
+    This manages two sets of URLs: 'seen_urls' and 'visited'.  'seen_urls'
+    is a Bloom filter of URLs seen, and 'visited' is a list of
+    FetchStatistics.
     """
-    def __init__(self, root, max_redirect=10, max_tasks=10, *, loop=None):
-        self.loop = loop or asyncio.get_event_loop()
+    def __init__(self, root, max_redirect=10, max_tasks=10, *, loop=None,
+                 build_sitemap=True):
+        # Defaults to the loop running crawl().
+        self.loop = loop
         self.root = root
         self.max_redirect = max_redirect
         self.max_tasks = max_tasks
-        self.q = Queue(loop=self.loop)
-        self.seen_urls = set()
+        self.build_sitemap = build_sitemap
+        # Pending (url, max_redirect) pairs. Workers wait on _has_work
+        # while it is empty; _done is set once no URL is queued or being
+        # fetched. Both events are created in crawl(), on the running loop.
+        self.q = deque()
+        self._has_work = None
+        self._done = None
+        self._pending = 0
+        self.seen_urls = ScalableBloomFilter(
+            initial_capacity=SEEN_URLS_CAPACITY,
+            error_rate=SEEN_URLS_ERROR_RATE)
         self.visited = []
-        self.session = aiohttp.ClientSession(loop=self.loop)
+        # Created in crawl(): aiohttp wants a running event loop.
+        self.session = None
         self.root_domain = self.extract_domain(root)
+        if self.root_domain.startswith('www.'):
+            other_root = self.root_domain[4:]
+        else:
+            other_root = 'www.' + self.root_domain
+        self._allowed_hosts = frozenset((self.root_domain, other_root))
         self.add_url(root)
         self.t0 = time.time()
         self.t1 = None
         self.sitemap = {}
-        linkregex = re.compile(b'<a [^>]*href=[\'|"](.*?)[\'"].*?>')
 
     def extract_domain(self, root):
         parts = urllib.parse.urlparse(root)
@@ -64,9 +108,10 @@ class Crawler:
 
         return host.lower()
 
-    def close(self):
+    async def close(self):
         """Close resources."""
-        self.session.close()
+        if self.session is not None:
+            await self.session.close()
 
     def is_redirect(self, response):
         return response.status in (300, 301, 302, 303, 307)
@@ -75,78 +120,65 @@ class Crawler:
         """
             Check if a host should be crawled.
         """
-        host = host.lower()
-
-        if host == self.root_domain:
-            return True
-
-        if re.match(r'\A[\d\.]*\Z', host):
-            return False
-
-        host = host[4:] if host.startswith('www.') else 'www.' + host
-        return host == self.root_domain
+        return host.lower() in self._allowed_hosts
 
     def record_statistic(self, fetch_statistic):
         """Record the FetchStatistic for completed / failed URL."""
         self.visited.append(fetch_statistic)
 
-    def update_sitemap(self, url, response, urls):
-        css_tags = BeautifulSoup(response, 'html.parser',
-            parse_only=SoupStrainer(name='link', attrs={'rel': 'stylesheet'})
-        )
-        image_tags = BeautifulSoup(response, 'html.parser',
-            parse_only=SoupStrainer(name='img'))
-        script_tags = BeautifulSoup(response, 'html.parser',
-            parse_only=SoupStrainer(name='script')
-        )
+    def update_sitemap(self, url, tree, urls):
+        # Keep only the tags' markup so no parse tree outlives its page.
+        css_tags = [tag.html for tag in tree.css('link[rel="stylesheet"]')]
+        image_tags = [tag.html for tag in tree.css('img')]
+        script_tags = [tag.html for tag in tree.css('script')]
 
         self.sitemap.update({
-            url: {'assets': [css_tags, image_tags, script_tags],
-            'links': urls}}
+            url: {'assets': {'css': css_tags,
+                             'img': image_tags,
+                             'script': script_tags},
+            'links': list(urls)}}
         )
 
     def normalize_url(self, url, response):
-        normalized = urllib.parse.urljoin(response.url, url)
+        normalized = urllib.parse.urljoin(str(response.url), url)
         defragmented, frag = urllib.parse.urldefrag(normalized)
         return defragmented
 
-    @asyncio.coroutine
-    def parse_response(self, response, url):
+    async def parse_response(self, response, url):
         """Return a FetchStatistic and list of links."""
         links = set()
         content_type = None
         encoding = None
-        body = yield from response.read()
+        body = await response.read()
 
         if response.status == 200:
-            content_type = response.headers.get('content-type')
-            pdict = {}
-
-            if content_type:
-                content_type, pdict = cgi.parse_header(content_type)
-
-            encoding = pdict.get('charset', 'utf-8')
+            # aiohttp parses the content-type header once per response.
+            content_type = response.content_type
+            encoding = response.charset or 'utf-8'
+            try:
+                codecs.lookup(encoding)
+            except LookupError:
+                LOGGER.debug('unknown charset %r for %r', encoding, url)
+                encoding = 'utf-8'
             if content_type in ('text/html', 'application/xml'):
-                text = yield from response.text()
-
-                # Replace href with (?:href|src) to follow image links.
-                # urls = set(re.findall(r'''(?i)href=["']([^\s"'<>]+)''', text))
-                urls = set([tag['href'] for tag in
-                    BeautifulSoup(text, 'html.parser',
-                        parse_only=SoupStrainer(name='a', href=True)
-                    )
-                ])
-                normalized_urls = set()
-                for url in urls:
-                    normalized = self.normalize_url(url, response)
-                    normalized_urls.add(normalized)
-                    if self.url_allowed(normalized):
-                        links.add(normalized)
-
-                self.update_sitemap(response.url, text, normalized_urls)
+                # Decode entities such as &amp; like an HTML parser would.
+                urls = {html.unescape(url) if '&' in url else url
+                        for url in (match.decode(encoding, 'replace')
+                                    for match in _find_hrefs(body))}
+                # Pages share most of their links; keep one copy of each
+                # crawlable URL.
+                links = {sys.intern(normalized) for url in urls
+                         if self.url_allowed(
+                             normalized := self.normalize_url(url, response))}
+
+                if self.build_sitemap:
+                    # Only build a DOM when the sitemap needs the assets.
+                    text = body.decode(encoding, errors='replace')
+                    tree = LexborHTMLParser(text)
+                    self.update_sitemap(str(response.url), tree, links)
 
         stat = FetchStatistic(
-            url=response.url,
+            url=str(response.url),
             next_url=None,
             status=response.status,
             exception=None,
@@ -154,7 +186,7 @@ class Crawler:
             content_type=content_type,
             encoding=encoding,
             num_urls=len(links),
-            num_new_urls=len(links - self.seen_urls))
+            num_new_urls=None)
 
         return stat, links
 
@@ -173,52 +205,64 @@ class Crawler:
             LOGGER.error('redirect limit reached for %r from %r',
                          next_url, url)
 
-    @asyncio.coroutine
-    def fetch(self, url, max_redirect):
+    async def fetch(self, url, max_redirect):
         """Fetch one URL."""
 
         try:
-            response = yield from self.session.get(
+            response = await self.session.get(
                 url, allow_redirects=False)
         except aiohttp.ClientError as client_error:
             msg = '{0} raised client error {1}. Aborting...'
             LOGGER.error(msg.format(url, client_error))
             return
+        except asyncio.TimeoutError:
+            LOGGER.error('{0} timed out. Aborting...'.format(url))
+            return
 
         try:
             if self.is_redirect(response):
                 self.process_redirect(response, url, max_redirect)
             else:
-                stat, links = yield from self.parse_response(response, url)
-                self.record_statistic(stat)
-                # Queue the links we haven't seen yet
-                for link in links.difference(self.seen_urls):
-                    self.q.put_nowait((link, self.max_redirect))
-                # Remember we have seen this URL.
-                self.seen_urls.update(links)
+                stat, links = await self.parse_response(response, url)
+                # Queue the links we haven't seen yet and remember them;
+                # add() returns True when the link was already there.
+                new = [(link, self.max_redirect) for link in links
+                       if not self.seen_urls.add(link)]
+                self.record_statistic(stat._replace(num_new_urls=len(new)))
+                self.enqueue(new)
+        except asyncio.TimeoutError:
+            LOGGER.error('{0} timed out reading body. Aborting...'.format(url))
         finally:
             # Return connection to pool.
-            yield from response.release()
+            await response.release()
 
-    @asyncio.coroutine
-    def work(self):
+    async def work(self):
         """Process queue items forever."""
         try:
             while True:
-                url, max_redirect = yield from self.q.get()
-                assert url in self.seen_urls
-                yield from self.fetch(url, max_redirect)
-                self.q.task_done()
+                while not self.q:
+                    self._has_work.clear()
+                    await self._has_work.wait()
+                url, max_redirect = self.q.popleft()
+                try:
+                    assert url in self.seen_urls
+                    await self.fetch(url, max_redirect)
+                except Exception:
+                    # Keep the worker alive for the rest of the queue.
+                    LOGGER.exception('error fetching %r', url)
+                finally:
+                    self._pending -= 1
+                    if not self._pending:
+                        self._done.set()
         except asyncio.CancelledError:
             pass
 
     def url_allowed(self, url):
-        parts = urllib.parse.urlparse(url)
-        if parts.scheme not in ('http', 'https'):
+        match = _URL_RE.match(url)
+        if not match:
             LOGGER.debug('skipping non-http scheme in %r', url)
             return False
-        host, port = urllib.parse.splitport(parts.netloc)
-        if not self.host_okay(host):
+        if not self.host_okay(match.group(2)):
             LOGGER.debug('skipping non-root host in %r', url)
             return False
         return True
@@ -227,17 +271,44 @@ class Crawler:
         """Add a URL to the queue if not seen before."""
         if max_redirect is None:
             max_redirect = self.max_redirect
+        url = sys.intern(url)
         LOGGER.debug('adding %r %r', url, max_redirect)
         self.seen_urls.add(url)
-        self.q.put_nowait((url, max_redirect))
+        self.enqueue([(url, max_redirect)])
 
-    @asyncio.coroutine
-    def crawl(self):
+    def enqueue(self, items):
+        """Queue (url, max_redirect) pairs and wake idle workers."""
+        if items:
+            self.q.extend(items)
+            self._pending += len(items)
+            if self._has_work is not None:
+                self._has_work.set()
+
+    async def crawl(self):
         """Run the crawler until all finished."""
-        workers = [asyncio.Task(self.work(), loop=self.loop)
-                   for _ in range(self.max_tasks)]
-        self.t0 = time.time()
-        yield from self.q.join()
-        self.t1 = time.time()
-        for w in workers:
-            w.cancel()
+        # The crawl stays on one host: cache its DNS lookup and keep
+        # enough sockets alive per host to serve every worker.
+        connector = aiohttp.TCPConnector(
+            limit=self.max_tasks * 2,
+            limit_per_host=self.max_tasks,
+            ttl_dns_cache=300,
+            use_dns_cache=True,
+            enable_cleanup_closed=True,
+            resolver=aiohttp.AsyncResolver())
+        self._has_work = asyncio.Event()
+        self._done = asyncio.Event()
+        loop = self.loop or asyncio.get_running_loop()
+        async with aiohttp.ClientSession(
+                connector=connector, timeout=REQUEST_TIMEOUT) as self.session:
+            workers = [loop.create_task(self.work())
+                       for _ in range(self.max_tasks)]
+            self.t0 = time.time()
+            try:
+                await self._done.wait()
+                self.t1 = time.time()
+            finally:
+                # Stop the workers, also when interrupted, before the
+                # session closes under them.
+                for w in workers:
+                    w.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
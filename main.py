@@ -1,10 +1,11 @@
-#!/usr/bin/env python3.4
+#!/usr/bin/env python3.8
 
 import argparse
 import asyncio
 import logging
 import sys
 import time
+import uvloop
 from datetime import datetime
 from crawler import Crawler
 
@@ -25,6 +26,9 @@ ARGS.add_argument(
 ARGS.add_argument(
     '--max_tasks', action='store', type=int, metavar='N',
     default=DEFAULT_MAX_TASKS, help='Limit concurrent connections')
+ARGS.add_argument(
+    '--no_sitemap', action='store_false', dest='build_sitemap',
+    help='Only list visited urls, skip collecting assets and links per page')
 
 
 def start():
@@ -33,28 +37,23 @@ def start():
     """
     args = ARGS.parse_args()
 
-    loop = asyncio.get_event_loop()
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
     url = args.target
     if '://' not in url:
         url = 'http://' + url
 
     crawler = Crawler(url, max_redirect=args.max_redirect,
-        max_tasks=args.max_tasks
+        max_tasks=args.max_tasks, build_sitemap=args.build_sitemap
     )
 
     try:
-        loop.run_until_complete(crawler.crawl())
+        asyncio.run(crawler.crawl())
     except KeyboardInterrupt:
         sys.stderr.flush()
         print('\nInterrupted\n')
     finally:
         # reporting.report(crawler)
-        crawler.close()
-        # Cleanup aiohttp resource
-        loop.stop()
-        loop.run_forever()
-        loop.close()
         visited_data = list(crawler.visited)
         visited_data.sort(key=lambda data: data.url)
         t1 = crawler.t1 or time.time()
@@ -62,32 +61,31 @@ def start():
         print('Crawling complete  in {}.'.format(dt))
         print('Writing file...')
         file_name = datetime.now().strftime('sitemap_%H_%M_%d_%m_%y.txt')
-        with open(file_name, 'w') as file:
+        # Build each section in memory and write it in one call.
+        with open(file_name, 'w', buffering=1024 * 1024) as file:
             file.write('***************** Sitemap ***************** \n')
-            for i, data in enumerate(visited_data):
-                count = i + 1
-                file.write('{0}. {1}  {2}\n'.format(
-                        count, data.url, data.status
-                    )
-                )
+            file.write(''.join(
+                '{0}. {1}  {2}\n'.format(i + 1, data.url, data.status)
+                for i, data in enumerate(visited_data)
+            ))
             file.write('\n\n')
 
             for url, data in crawler.sitemap.items():
-                # assets = ', '.join(str(a) for a in data['assets'])
+                section = []
                 txt = '\n\n ***************** Assets on {0} ***************** '
-                file.write(txt.format(url))
-                file.write('\n')
-                for asset in data['assets']:
-                    for a in asset:
-                        file.write('\n - {0}'.format(a.prettify()))
+                section.append(txt.format(url))
+                section.append('\n')
+                section.extend('\n - {0}'.format(a)
+                               for asset in data['assets'].values()
+                               for a in asset)
 
-                links = data['links']
                 txt = '\n\n***************** Links on {0} ***************** '
-                file.write(txt.format(url))
-                file.write('\n')
-                for link in links:
-                    file.write('\n - {0}'.format(link))
-                file.write('\n\n')
+                section.append(txt.format(url))
+                section.append('\n')
+                section.extend('\n - {0}'.format(link)
+                               for link in data['links'])
+                section.append('\n\n')
+                file.write(''.join(section))
 
 
 if __name__ == '__main__':